@@ -18,11 +18,18 @@ from __future__ import division
 from __future__ import print_function
 
 import argparse
+import functools
 import os
 import platform
+import queue
 import subprocess
 import sys
 import re
+import threading
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
 
 from compat import iteritems, quote
 
@@ -65,7 +72,19 @@ LINUX_BUILD_CONFIGS = {
 
 LINUX_ARCHS = ('arm', 'arm64',)
 
+# Only the GCC configs are cross-compiled for LINUX_ARCHS.
+_LINUX_GCC_CONFIGS = {
+    name for name, gn_args in iteritems(LINUX_BUILD_CONFIGS)
+    if 'is_clang=false' in gn_args
+}
+
+# The gn args of a config, joined once for gn's --args and for logging.
+GnConfig = namedtuple('GnConfig', ['args_space', 'args_comma'])
+
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+OUT_BASE_DIR = os.path.join(ROOT_DIR, 'out')
+GN_BIN = os.path.join(ROOT_DIR, 'tools', 'gn')
+NINJA_BIN = os.path.join(ROOT_DIR, 'tools', 'ninja')
 
 OPENBMC_BUILD_CONFIGS = {
     'openbmc_gcc_debug':   ('is_clang=false', 'is_debug=true' ),
@@ -74,66 +93,187 @@ OPENBMC_BUILD_CONFIGS = {
 
 OPENBMC_ARCHS = ('arm',)
 
+# Matches everything in the generated toolchain.ninja that has to be pointed
+# at the OpenBMC SDK, in a single pass. Each alternative is a named group so
+# that the replacement can be looked up from m.lastgroup. The gcc alternative
+# also covers the "gcc" prefix of "arm-linux-gnueabihf-gcc-ar".
+_OPENBMC_TOOLCHAIN_RE = re.compile(
+    r"(?P<sysroot>--sysroot=\S+)"
+    r"|arm-linux-gnueabihf-(?:(?P<gxx>g\+\+)|(?P<gcc>gcc)|(?P<ar>ar))"
+    r"|(?P<strip> strip )")
+
+_OPENBMC_TOOL_SUFFIXES = ("gnueabi-g++", "gnueabi-gcc-ar", "gnueabi-gcc",
+                          "gnueabi-strip")
+
+# Flags in the generated .ninja files that the OpenBMC toolchain doesn't
+# support, and what to replace them with.
+_ICF_FLAGS = {
+    "-Wl,--icf=all": "",
+    "-Werror": "",
+    "-mfpu=neon": "",
+    "-mthumb": "",
+    "-march=armv7-a": "-marm -mcpu=arm1176jz-s",  # TODO
+}
+_ICF_FLAGS_RE = re.compile("|".join(re.escape(x) for x in _ICF_FLAGS))
+
 def GetOpenBMCVariables(sdkpath):
   ret = {}
-  maybe_sr = os.path.join(sdkpath, "sysroots")
-  if os.path.exists(maybe_sr):
-    for p in os.listdir(maybe_sr):
+  sdkpath = os.path.expanduser(sdkpath)
+  # The sysroot is looked up directly rather than during the walk below, as
+  # os.walk() doesn't descend into <sdk>/sysroots if it is a symlink.
+  sysroots = os.path.join(sdkpath, "sysroots")
+  if os.path.isdir(sysroots):
+    for p in os.listdir(sysroots):
       if p.endswith("gnueabi"):
-        ret["sysroot"] = os.path.join(maybe_sr, p)
-  filenames = [os.path.join(dp, f) for dp, dn, fn in \
-    os.walk(os.path.expanduser(sdkpath)) for f in fn]
-  for fn in filenames:
-    fn = fn.strip()
-    if fn.endswith("gnueabi-g++"):
-      ret["g++"] = fn
-    elif fn.endswith("gnueabi-gcc-ar"):
-      ret["ar"] = fn
-    elif fn.endswith("gnueabi-gcc"):
-      ret["gcc"] = fn
-    elif fn.endswith("gnueabi-strip"):
-      ret["strip"] = fn
+        ret["sysroot"] = os.path.join(sysroots, p)
+  for dp, _, fns in os.walk(sdkpath):
+    for name in fns:
+      if not name.endswith(_OPENBMC_TOOL_SUFFIXES):
+        continue
+      fn = os.path.join(dp, name).strip()
+      if fn.endswith("gnueabi-g++"):
+        ret["g++"] = fn
+      elif fn.endswith("gnueabi-gcc-ar"):
+        ret["ar"] = fn
+      elif fn.endswith("gnueabi-gcc"):
+        ret["gcc"] = fn
+      elif fn.endswith("gnueabi-strip"):
+        ret["strip"] = fn
+    if len(ret) == 5:
+      break
   return ret
 
 def ProcessOpenBMCToolchainNinjaFile(file_path, openbmc_vars):
-  with open(file_path) as f:
-    lines = f.readlines()
-    for i in range(len(lines)):
-      lines[i] = re.sub("--sysroot=[\S]+",
-                        "--sysroot=" + openbmc_vars["sysroot"],
-                        lines[i])
-      lines[i] = lines[i].replace("arm-linux-gnueabihf-g++",
-                                  openbmc_vars["g++"])
-      lines[i] = lines[i].replace("arm-linux-gnueabihf-gcc",
-                                  openbmc_vars["gcc"])
-      lines[i] = lines[i].replace("arm-linux-gnueabihf-ar",
-                                  openbmc_vars["ar"])
-      lines[i] = lines[i].replace(" strip ",
-                                  " " + openbmc_vars["strip"] + " ")
-  with open(file_path, 'w') as f:
-    for line in lines:
-      f.write(line)
+  replacements = {
+      "sysroot": "--sysroot=" + openbmc_vars["sysroot"],
+      "gxx": openbmc_vars["g++"],
+      "gcc": openbmc_vars["gcc"],
+      "ar": openbmc_vars["ar"],
+      "strip": " " + openbmc_vars["strip"] + " ",
+  }
+
+  path = Path(file_path)
+  path.write_text(
+      _OPENBMC_TOOLCHAIN_RE.sub(lambda m: replacements[m.lastgroup],
+                                path.read_text()))
+
+def _RemoveICFAllFlagFromFile(fn):
+  path = Path(fn)
+  text, replaced = _ICF_FLAGS_RE.subn(lambda m: _ICF_FLAGS[m.group(0)],
+                                      path.read_text())
+  # Only rewrite files that changed, to avoid bumping their mtime.
+  if replaced:
+    path.write_text(text)
+
+def _IterNinjaFiles(root):
+  """Yields the path of every .ninja file under |root|, recursively."""
+  stack = [root]
+  while stack:
+    with os.scandir(stack.pop()) as it:
+      for entry in it:
+        if entry.is_dir(follow_symlinks=False):
+          stack.append(entry.path)
+        elif entry.name.endswith(".ninja"):
+          yield entry.path
 
 def RemoveICFAllFlag(out_dir):
-  filenames = [os.path.join(dp, f) for dp, dn, fn in \
-    os.walk(os.path.expanduser(out_dir)) for f in fn]
-  for fn in filenames:
-    if fn.endswith(".ninja"):
-      with open(fn) as f:
-        lines = f.readlines()
-      replaced = False
-      for i in range(len(lines)):
-        for x in ["-Wl,--icf=all", "-Werror", "-mfpu=neon", "-mthumb"]:
-          if x in lines[i]:
-            lines[i] = lines[i].replace(x, "")
-            replaced = True
-        if "-march=armv7-a" in lines[i]:
-          lines[i] = lines[i].replace("-march=armv7-a",
-                                      "-marm -mcpu=arm1176jz-s") # TODO
-          replaced = True
-      if replaced:
-        with open(fn, "w") as f:
-          for line in lines: f.write(line)
+  with ThreadPoolExecutor() as executor:
+    list(executor.map(_RemoveICFAllFlagFromFile,
+                      _IterNinjaFiles(os.path.expanduser(out_dir))))
+
+def _SchedulePostProcessing(out_dir, openbmc_vars, pool):
+  """Submits the OpenBMC rewrites of the .ninja files in |out_dir| to |pool|.
+
+  Returns the list of futures. toolchain.ninja goes through both rewrites,
+  which are done by a single job so that they don't race.
+  """
+  toolchain_file = os.path.join(out_dir, "toolchain.ninja")
+
+  def ProcessToolchainFile():
+    ProcessOpenBMCToolchainNinjaFile(toolchain_file, openbmc_vars)
+    _RemoveICFAllFlagFromFile(toolchain_file)
+
+  futures = [pool.submit(ProcessToolchainFile)]
+  for fn in _IterNinjaFiles(out_dir):
+    if fn != toolchain_file:
+      futures.append(pool.submit(_RemoveICFAllFlagFromFile, fn))
+  return futures
+
+def _GenerateConfig(item, args):
+  """Generates a single config, ready to be built with ninja.
+
+  Runs in a worker process. Returns a (config_name, ok, output) tuple, where
+  output is the text to be printed by the caller once the config is done
+  (including the output of gn), so that the logs of concurrent configs don't
+  interleave.
+  """
+  config_name, config = item
+  output = ['\n\033[32mBuilding %-20s[%s]\033[0m' %
+            (config_name, config.args_comma)]
+  out_dir = os.path.join(OUT_BASE_DIR, config_name)
+  os.makedirs(out_dir, exist_ok=True)
+  gn_cmd = (GN_BIN, 'gen', out_dir, '--args=%s' % config.args_space, '--check')
+  if args.export_compile_commands:
+    gn_cmd += ('--export-compile-commands',)
+  output.append(' '.join(quote(c) for c in gn_cmd))
+  try:
+    res = subprocess.run(
+        gn_cmd, cwd=ROOT_DIR, capture_output=True, text=True, check=True)
+  except subprocess.CalledProcessError as e:
+    output += [(e.stdout + e.stderr).rstrip(), str(e)]
+    return config_name, False, '\n'.join(output)
+  output.append((res.stdout + res.stderr).rstrip())
+  return config_name, True, '\n'.join(output)
+
+class _SerialNinjaBuilder(object):
+  """Runs ninja for the configs it is given, one at a time, in the background.
+
+  This lets the build of a config overlap with the generation of the next
+  ones, while still running a single ninja (with its default -j) at a time,
+  so that builds don't oversubscribe the machine or interleave their output.
+  Like the serial loop it replaces, it stops at the first failing build:
+  |failed| is then set to the name of that config.
+  """
+
+  def __init__(self, target):
+    self._ninja_cmd = (NINJA_BIN, '-C', '.', target)
+    self._queue = queue.Queue()
+    self.failed = None
+    self._thread = threading.Thread(target=self._Run)
+    self._thread.start()
+
+  def Add(self, config_name):
+    self._queue.put(config_name)
+
+  def Finish(self, cancel=False):
+    """Waits for the builds and returns the config that failed, if any.
+
+    If |cancel| is True, the builds that haven't started yet are dropped and
+    only the one in progress, if any, is waited for.
+    """
+    if cancel:
+      while not self._queue.empty():
+        self._queue.get_nowait()
+    self._queue.put(None)
+    self._thread.join()
+    return self.failed
+
+  def _Run(self):
+    while True:
+      config_name = self._queue.get()
+      if config_name is None:
+        return
+      if self.failed:
+        continue
+      print('\n\033[32mRunning ninja for %s\033[0m' % config_name)
+      out_dir = os.path.join(OUT_BASE_DIR, config_name)
+      try:
+        ok = subprocess.call(self._ninja_cmd, cwd=out_dir) == 0
+      except OSError as e:
+        print(e)
+        ok = False
+      if not ok:
+        self.failed = config_name
 
 def main():
   parser = argparse.ArgumentParser()
@@ -149,14 +289,17 @@ def main():
   print(args.openbmc_sdk)
 
   configs = {}
+  openbmc_vars = None
   if not args.host_only:
     if args.openbmc:
       print("OpenBMC build")
     if args.android:
+      arch_args = [(arch, ('target_cpu="%s"' % arch,))
+                   for arch in ANDROID_ARCHS]
       for config_name, gn_args in iteritems(ANDROID_BUILD_CONFIGS):
-        for arch in ANDROID_ARCHS:
+        for arch, extra_args in arch_args:
           full_config_name = '%s_%s' % (config_name, arch)
-          configs[full_config_name] = gn_args + ('target_cpu="%s"' % arch,)
+          configs[full_config_name] = gn_args + extra_args
     if args.openbmc:
       if args.openbmc_sdk is None:
         print("Please specify OpenBMC SDK location using '--openbmc-sdk SDK_PATH"
@@ -166,18 +309,21 @@ def main():
       if len(openbmc_vars) < 5:
         print("The specified SDK path does not look valid.")
         exit(0)
+      arch_args = [(arch, ('target_cpu="%s"' % arch,))
+                   for arch in OPENBMC_ARCHS]
       for config_name, gn_args in iteritems(OPENBMC_BUILD_CONFIGS):
-        for arch in OPENBMC_ARCHS:
+        for arch, extra_args in arch_args:
           full_config_name = '%s_%s' % (config_name, arch)
-          configs[full_config_name] = gn_args + ('target_cpu="%s"' % arch,)
+          configs[full_config_name] = gn_args + extra_args
     else:
+      arch_args = [(arch, ('target_cpu="%s"' % arch, 'target_os="linux"'))
+                   for arch in LINUX_ARCHS]
       for config_name, gn_args in iteritems(LINUX_BUILD_CONFIGS):
-        if dict(a.split('=') for a in gn_args).get('is_clang', None) == 'true':
+        if config_name not in _LINUX_GCC_CONFIGS:
           continue
-        for arch in LINUX_ARCHS:
+        for arch, extra_args in arch_args:
           full_config_name = '%s_%s' % (config_name, arch)
-          configs[full_config_name] = gn_args + ('target_cpu="%s"' % arch,
-                                                 'target_os="linux"')
+          configs[full_config_name] = gn_args + extra_args
 
   system = platform.system().lower()
   if system == 'linux':
@@ -189,36 +335,87 @@ def main():
     assert False, 'Unsupported system %r' % system
 
   if args.ccache:
-    for config_name, gn_args in iteritems(configs):
-      configs[config_name] = gn_args + ('cc_wrapper="ccache"',)
-
-  out_base_dir = os.path.join(ROOT_DIR, 'out')
-  if not os.path.isdir(out_base_dir):
-    os.mkdir(out_base_dir)
-
-  gn = os.path.join(ROOT_DIR, 'tools', 'gn')
-
-  for config_name, gn_args in iteritems(configs):
-    print('\n\033[32mBuilding %-20s[%s]\033[0m' % (config_name,
-                                                   ','.join(gn_args)))
-    out_dir = os.path.join(ROOT_DIR, 'out', config_name)
-    if not os.path.isdir(out_dir):
-      os.mkdir(out_dir)
-    gn_cmd = (gn, 'gen', out_dir, '--args=%s' % (' '.join(gn_args)), '--check')
-    if args.export_compile_commands:
-      gn_cmd += ('--export-compile-commands',)
-    print(' '.join(quote(c) for c in gn_cmd))
-    subprocess.check_call(gn_cmd, cwd=ROOT_DIR)
-    if args.build:
-      ninja = os.path.join(ROOT_DIR, 'tools', 'ninja')
-      ninja_cmd = (ninja, '-C', '.', args.build)
-      subprocess.check_call(ninja_cmd, cwd=out_dir)
+    ccache = ('cc_wrapper="ccache"',)
+    configs = {k: v + ccache for k, v in iteritems(configs)}
 
-    if args.openbmc:
-      print("Post-proessing OpenBMC build configuration")
-      ProcessOpenBMCToolchainNinjaFile(os.path.join(out_dir, "toolchain.ninja"),
-                                       openbmc_vars)
-      RemoveICFAllFlag(out_dir)
+  configs = {
+      k: GnConfig(' '.join(v), ','.join(v)) for k, v in iteritems(configs)
+  }
+
+  os.makedirs(OUT_BASE_DIR, exist_ok=True)
+
+  # Configs are generated in parallel. As soon as a config has been
+  # generated it is queued for building, so that its ninja build overlaps
+  # with the generation of the remaining configs. Builds run one at a time.
+  # OpenBMC configs first need their .ninja files rewritten: that is I/O
+  # bound, so the files of all configs go through a single thread pool and
+  # their builds are only queued once all the rewrites are done.
+  # Like the serial loop did, everything stops at the first failing gn gen or
+  # ninja build: no more builds are queued, and only the one in progress is
+  # allowed to complete.
+  generate = functools.partial(_GenerateConfig, args=args)
+  builder = _SerialNinjaBuilder(args.build) if args.build else None
+  io_pool = None
+  if args.openbmc:
+    io_pool = ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4))
+  failed = None
+  completed = False
+  post_processing = []
+
+  def QueueBuild(config_name):
+    if not builder:
+      return True
+    if builder.failed:
+      return False
+    builder.Add(config_name)
+    return True
+
+  try:
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+      futures = [executor.submit(generate, item) for item in iteritems(configs)]
+      try:
+        for future in futures:
+          config_name, ok, output = future.result()
+          print(output)
+          if not ok:
+            failed = config_name
+            break
+          if io_pool:
+            print("Post-processing OpenBMC build configuration")
+            out_dir = os.path.join(OUT_BASE_DIR, config_name)
+            post_processing.append(
+                (config_name,
+                 _SchedulePostProcessing(out_dir, openbmc_vars, io_pool)))
+          elif not QueueBuild(config_name):
+            break
+        else:
+          for config_name, rewrites in post_processing:
+            for rewrite in rewrites:
+              rewrite.result()
+            if not QueueBuild(config_name):
+              break
+          else:
+            completed = True
+      finally:
+        # Configs that are already being generated can't be interrupted and
+        # still complete.
+        for f in futures:
+          f.cancel()
+  finally:
+    if io_pool:
+      for _, rewrites in post_processing:
+        for rewrite in rewrites:
+          rewrite.cancel()
+      io_pool.shutdown()
+    # Don't leave a ninja running behind if anything above failed or raised.
+    if builder:
+      build_failed = builder.Finish(cancel=not completed)
+      failed = failed or build_failed
+
+  if failed:
+    print('\033[31mFailed building %s\033[0m' % failed)
+    return 1
+  return 0
 
 if __name__ == '__main__':
   sys.exit(main())